@@ -23,9 +23,43 @@
 
 #-------------------------------------------------------------------------------
 
+import functools
 import os
 import re
 
+#-------------------------------------------------------------------------------
+# Precompiled regular expressions
+#-------------------------------------------------------------------------------
+
+# Field components such as f[X] or f[XY]
+_component_1_re = re.compile(r'\[[A-Za-z0-9]\]')
+_component_2_re = re.compile(r'\[[A-Za-z0-9][A-Za-z0-9]\]')
+
+#-------------------------------------------------------------------------------
+# Character classes used for segments splitting and tokenization
+#-------------------------------------------------------------------------------
+
+_segment_whitespace = frozenset((' ', '\t', '\n'))
+_segment_separators = frozenset(('{', '}', ';'))
+
+_token_whitespace = frozenset((' ', '\t', '\n', '\r'))
+_token_sep2 = frozenset(('<=', '>=', '!=', '==', '||', '&&',
+                         '+=', '-=', '*=', '/=', '**'))
+_token_sep1 = frozenset(('=', '(', ')', ';', ',', ':', '{', '}',
+                         '+', '-', '*', '/', '<', '>',  '^', '%', '!', '?'))
+_token_digits_p = frozenset(('.', '0', '1', '2', '3', '4',
+                             '5', '6', '7', '8', '9'))
+
+#-------------------------------------------------------------------------------
+# Mathematical functions renaming
+#-------------------------------------------------------------------------------
+
+_cs_math_internal_name = {'abs':'cs_math_fabs',
+                          'min':'cs_math_fmin',
+                          'max':'cs_math_fmax',
+                          'mod':'fmod',
+                          'square_norm':'cs_math_3_square_norm'}
+
 #===============================================================================
 # Utility functions
 #===============================================================================
@@ -57,10 +91,10 @@ def split_req_components(req_list):
     for r in req_list:
 
         rf = r
-        if bool(re.search('\[[A-Za-z0-9]\]', r)):
-            rf = re.sub('\[[A-Za-z0-9]\]', '', r)
-        elif bool(re.search('\[[A-Za-z0-9][A-Za-z0-9]\]', r)):
-            rf = re.sub('\[[A-Za-z0-9][A-Za-z0-9]\]', '', r)
+        if bool(_component_1_re.search(r)):
+            rf = _component_1_re.sub('', r)
+        elif bool(_component_2_re.search(r)):
+            rf = _component_2_re.sub('', r)
 
         if rf == r:
             req_fields.append(create_req_field(r,1))
@@ -176,8 +210,8 @@ class cs_math_parser:
         start line and column indexes in the original expression.
         """
 
-        whitespace = (' ', '\t', '\n', '\l')
-        separators = ('{', '}', ';')
+        whitespace = _segment_whitespace
+        separators = _segment_separators
         segments = []
 
         in_multiline_comment = False
@@ -396,12 +430,6 @@ class cs_math_parser:
         Rename mathematical functions using the internal functions of
         code_saturne or standard math library.
         """
-        _cs_math_internal_name = {'abs':'cs_math_fabs',
-                                  'min':'cs_math_fmin',
-                                  'max':'cs_math_fmax',
-                                  'mod':'fmod',
-                                  'square_norm':'cs_math_3_square_norm'}
-
         new_exp = []
 
         for e in expressions:
@@ -410,9 +438,9 @@ class cs_math_parser:
                 new_exp.append(self.rename_math_functions(e))
 
             else:
-                if e[0] in _cs_math_internal_name.keys():
+                en = _cs_math_internal_name.get(e[0])
+                if en is not None:
                     li, ci = self.get_start_lc(e)
-                    en = _cs_math_internal_name[e[0]]
                     new_exp.append((en, li, ci))
 
                 else:
@@ -464,8 +492,7 @@ class cs_math_parser:
                     if s_col > 0: # add space to nonempty column
                         text += ' '
                     if s_col < c[2]:
-                        for j in range(c[2]):
-                            text += ' '
+                        text += ' '*c[2]
                     text += '//' + c[0][1:]
 
             # Recursive handling of code
@@ -495,11 +522,8 @@ class cs_math_parser:
             else:
 
                 if s_line < li:
-                    text += '\n'
-                    s_col = 0
-                    for i in range(ci):
-                        text += ' '
-                        s_col += 1
+                    text += '\n' + ' '*ci
+                    s_col = ci
 
                 else:      # Try to put spaces in recommended places
                     add_space = True
@@ -532,9 +556,8 @@ class cs_math_parser:
                     while line_cur < line_ref:
                         text += '\n'
                         line_cur += 1
-                        for j in range(c[2]):
-                            text += ' '
-                            text += '//' + c[0][1:]
+                        text += ' '*c[2]
+                        text += '//' + c[0][1:]
                         line_ref = line_cur
                     text += '\n\n'
 
@@ -547,11 +570,10 @@ class cs_math_parser:
         Tokenize segments and separate comments.
         """
 
-        whitespace = (' ', '\t', '\n', '\l', '\r')
-        sep2 = ('<=', '>=', '!=', '==', '||', '&&', '+=', '-=', '*=', '/=', '**')
-        sep1 = ('=', '(', ')', ';', ',', ':', '{', '}',
-                '+', '-', '*', '/', '<', '>',  '^', '%', '!', '?')
-        digits_p = ('.', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9')
+        whitespace = _token_whitespace
+        sep2 = _token_sep2
+        sep1 = _token_sep1
+        digits_p = _token_digits_p
 
         tokens = []
         comments = []
@@ -598,6 +620,20 @@ class cs_math_parser:
 
     #---------------------------------------------------------------------------
 
+    def tokenize_expression(self, expression):
+        """
+        Split an expression into tokens and comments.
+        Results are cached by expression, as the same expression is
+        often parsed several times (syntax checks, saves).
+        Returned lists may be modified by the caller.
+        """
+
+        tokens, comments = _tokenize_expression_cached(expression)
+
+        return list(tokens), list(comments)
+
+    #---------------------------------------------------------------------------
+
     def build_expressions(self, exp_lines, tokens):
         """
         Organize expressions as lists of subexpressions based on levels
@@ -722,27 +758,33 @@ class cs_math_parser:
 
         # Parse the Mathematical expression and generate the C block code
         exp_lines = expression.split("\n")
-        segments = self.separate_segments(exp_lines)
-        tokens, comments = self.tokenize(segments)
+        tokens, comments = self.tokenize_expression(expression)
+
+        # Known symbols are also tracked in a set, so that each token
+        # is checked only once in a single pass, in constant time.
+        known_set = set(known_symbols)
 
         for t in tokens:
             tk = t[0]
-            if tk not in known_symbols:
+            if tk not in known_set:
                 # We use a double if and not if/else because some symbols
                 # may be present in both lists
-                if tk in glob_tokens.keys():
+                if tk in glob_tokens:
                     usr_defs.append(glob_tokens[tk] + '\n')
                     known_symbols.append(tk)
-                if tk in loop_tokens.keys():
+                    known_set.add(tk)
+                if tk in loop_tokens:
                     usr_code.append(loop_tokens[tk] + '\n')
-                    if tk not in known_symbols:
+                    if tk not in known_set:
                         known_symbols.append(tk)
+                        known_set.add(tk)
 
                     # For momentum source terms, check for velocity
-                    if func_type == "src" and tk in ['u','v','w']:
-                        if 'velocity' not in known_symbols:
+                    if func_type == "src" and tk in ('u','v','w'):
+                        if 'velocity' not in known_set:
                             if 'velocity' in glob_tokens:
                                 known_symbols.append('velocity')
+                                known_set.add('velocity')
                                 usr_defs.append(glob_tokens['velocity']+'\n')
 
         #-------------------------
@@ -758,16 +800,21 @@ class cs_math_parser:
             # Check for assignments:
             if tk == "=" and t_i > 0:
                 tk0 = tokens[t_i-1][0]
-                if tk0 not in known_symbols:
+                if tk0 not in known_set:
                     usr_defs.append('cs_real_t %s = -1.;\n' % tk0)
                     known_symbols.append(tk0)
+                    known_set.add(tk0)
 
+        # Index of first occurrence of each required symbol
+        req_ids = {}
+        for ir, r in enumerate(req):
+            req_ids.setdefault(r, ir)
 
         req_to_replace = [elt for elt in req]
         for t_i, t in enumerate(tokens):
             tk = t[0]
             new_v = None
-            if tk in req:
+            if tk in req_ids:
                 if func_type == 'vol':
                     fid, fcomp, fdim = get_req_field_info(req_fields, tk)
                     if fid is None:
@@ -779,7 +826,7 @@ class cs_math_parser:
                         new_v = 'f[%d]->val[c_id*%d + %d]' % (fid, fdim, fcomp)
 
                 elif func_type == 'bnd':
-                    ir = req.index(tk)
+                    ir = req_ids[tk]
                     if need_for_loop:
                         new_v = 'new_vals[%d * n_elts + e_id]' % (ir)
                     else:
@@ -787,7 +834,7 @@ class cs_math_parser:
 
                 elif func_type in ['src', 'ini']:
                     if nreq > 1:
-                        ir = req.index(tk)
+                        ir = req_ids[tk]
                         new_v = 'new_vals[%d * e_id + %d]' % (nreq, ir)
                     else:
                         new_v = 'new_vals[e_id]'
@@ -817,14 +864,27 @@ class cs_math_parser:
 
         # Rebuild lines
         new_text = self.rebuild_text(tokens, comments)
-        for line in new_text[0].split('\n'):
-            usr_code.append(line + '\n')
-        if len(new_text[1]) > 0:
-            for c in new_text[1]:
-                usr_code.append('//' + c[0][1:] + '\n')
+        usr_code.extend([line + '\n' for line in new_text[0].split('\n')])
+        usr_code.extend(['//' + c[0][1:] + '\n' for c in new_text[1]])
 
         #-------------------------
 
         return usr_code, usr_defs
 
 #-------------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=256)
+def _tokenize_expression_cached(expression):
+    """
+    Split an expression into tokens and comments, returned as tuples
+    so that cached values cannot be modified.
+    """
+
+    parser = cs_math_parser()
+
+    segments = parser.separate_segments(expression.split("\n"))
+    tokens, comments = parser.tokenize(segments)
+
+    return tuple(tokens), tuple(comments)
+
+#-------------------------------------------------------------------------------
@@ -23,13 +23,16 @@
 
 #-------------------------------------------------------------------------------
 
+import filecmp
+import functools
+import io
 import os
 import re
+import shutil
+import unittest
 
 from code_saturne.base.cs_math_parser import cs_math_parser
 
-from code_saturne.model.NotebookModel import NotebookModel
-from code_saturne.model.TimeTablesModel import TimeTablesModel
 from code_saturne.model.SolutionDomainModel import getRunType
 
 #===============================================================================
@@ -89,6 +92,12 @@ END_C_DECLS
 
 """
 
+# Complete file headers, assembled once per package
+
+_pkg_file_header = {'code_saturne': _file_header + _file_header3,
+                    'neptune_cfd': _file_header + _file_header3}
+#                   'neptune_cfd': _file_header + _file_header2 + _file_header3}
+
 _function_header = { \
 'vol':"""void
 cs_meg_volume_function(const char      *zone_name,
@@ -156,6 +165,24 @@ cs_meg_post_activate(void)
 """
 }
 
+_function_return = {'vol': '',
+                    'bnd': '  return new_vals;\n',
+                    'src': '  return new_vals;\n',
+                    'ini': '  return new_vals;\n',
+                    'ibm': '',
+                    'fsi': '',
+                    'pfl': '',
+                    'pwa': ''}
+
+# Complete fixed code before and after the blocks of each function file
+
+_function_prologue = {pkg: {ft: header + fh
+                            for ft, fh in _function_header.items()}
+                      for pkg, header in _pkg_file_header.items()}
+
+_function_epilogue = {ft: fr + _file_footer
+                      for ft, fr in _function_return.items()}
+
 _function_names = {'vol': 'cs_meg_volume_function.c',
                    'bnd': 'cs_meg_boundary_function.c',
                    'src': 'cs_meg_source_terms.c',
@@ -165,6 +192,8 @@ _function_names = {'vol': 'cs_meg_volume_function.c',
                    'pfl': 'cs_meg_post_profile.c',
                    'pwa': 'cs_meg_post_output.c'}
 
+_block_banner = '  /* {title}\n    -{dashes} */\n\n'
+
 _block_comments = {'vol': 'User defined formula for variable(s) %s over zone %s',
                    'bnd': 'User defined formula for "%s" over BC=%s',
                    'src': 'User defined source term for %s over zone %s',
@@ -185,6 +214,42 @@ _func_short_to_long = {'vol': 'volume zone',
 
 #-------------------------------------------------------------------------------
 
+# Boundary turbulence formula block name and required variables
+# for each turbulence model (only those allowing a formula).
+# Careful! The order of rij components must be the same as in the code
+# (r23 before r13)
+
+_bnd_turbulence_blocks = \
+    {'k-epsilon':        ('turbulence_ke', ('k', 'epsilon')),
+     'k-epsilon-PL':     ('turbulence_ke', ('k', 'epsilon')),
+     'Rij-epsilon':      ('turbulence_rije', ('r11', 'r22', 'r33',
+                                              'r12', 'r23', 'r13',
+                                              'epsilon')),
+     'Rij-SSG':          ('turbulence_rije', ('r11', 'r22', 'r33',
+                                              'r12', 'r23', 'r13',
+                                              'epsilon')),
+     'Rij-EBRSM':        ('turbulence_rij_ebrsm', ('r11', 'r22', 'r33',
+                                                   'r12', 'r23', 'r13',
+                                                   'epsilon', 'alpha')),
+     'v2f-BL-v2/k':      ('turbulence_v2f', ('k', 'epsilon', 'phi', 'alpha')),
+     'k-omega-SST':      ('turbulence_kw', ('k', 'omega')),
+     'Spalart-Allmaras': ('turbulence_spalart', ('nu_tilda',))}
+
+# Boundary turbulence formula block name prefix for each neptune_cfd
+# turbulence model (required variables are provided by the model).
+
+_bnd_turbulence_blocks_neptune = \
+    {'k-epsilon':                   'turbulence_ke',
+     'k-epsilon_linear_production': 'turbulence_ke',
+     'rij-epsilon_ssg':             'turbulence_rije',
+     'rij-epsilon_ebrsm':           'turbulence_rije',
+     'q2-q12-tchen':                'turbulence_tchen',
+     'q2-q12':                      'turbulence_tchen',
+     'r2-q12':                      'turbulence_r2q12',
+     'r2-r12-tchen':                'turbulence_r2r12'}
+
+#-------------------------------------------------------------------------------
+
 _pkg_fluid_prop_dict = {}
 _pkg_fluid_prop_dict['code_saturne'] = {'rho0':'ro0',
                                         'mu0':'viscl0',
@@ -202,6 +267,15 @@ _pkg_fluid_prop_dict['neptune_cfd'] = {'rho0':'ro0',
 _pkg_glob_struct = {'code_saturne':'cs_glob_fluid_properties',
                     'neptune_cfd':'nc_phases->p_ini[PHASE_ID]'}
 
+# Coordinate definitions inside cell and boundary face loops
+_cell_coord_tokens = {'x':'const cs_real_t x = xyz[c_id][0];',
+                      'y':'const cs_real_t y = xyz[c_id][1];',
+                      'z':'const cs_real_t z = xyz[c_id][2];'}
+
+_bnd_coord_tokens = {'x':'const cs_real_t x = xyz[b_e_id][0];',
+                     'y':'const cs_real_t y = xyz[b_e_id][1];',
+                     'z':'const cs_real_t z = xyz[b_e_id][2];'}
+
 #---------------------------------------------------------------------------
 
 _base_tokens = {'dt':'const cs_real_t dt = cs_glob_time_step->dt[0];',
@@ -217,6 +291,24 @@ _base_tokens = {'dt':'const cs_real_t dt = cs_glob_time_step->dt[0];',
                 'gx':'const cs_real_t gx = cs_glob_physical_constants->gravity[0];',
                 'gy':'const cs_real_t gy = cs_glob_physical_constants->gravity[1];',
                 'gz':'const cs_real_t gz = cs_glob_physical_constants->gravity[2];'}
+
+#---------------------------------------------------------------------------
+
+# Translation table mapping expression separators to whitespace
+# (operators such as '&&' or '||' are handled character by character)
+
+_expression_separators = str.maketrans({c: ' ' for c in '=+-*/();,^<>&|'})
+
+#---------------------------------------------------------------------------
+
+# Parsed expressions cache, shared by all interpreter instances
+# (the GUI creates a new interpreter for each formula check).
+# Keys are the representation of the expression and its parsing context;
+# the oldest entries are dropped beyond the maximum size.
+
+_parsed_expressions = {}
+_parsed_expressions_max_size = 256
+
 #---------------------------------------------------------------------------
 
 def _error_and_exit(msg):
@@ -238,8 +330,15 @@ def parse_gui_expression(expression,
                          indent_decl = 2,
                          indent_main = 3):
 
-    usr_code = ''
-    usr_defs = ''
+    # Check for a previously parsed identical expression
+
+    key = repr((expression, req, known_symbols, func_type,
+                glob_tokens, loop_tokens, need_for_loop,
+                indent_decl, indent_main))
+
+    if key in _parsed_expressions:
+        return _parsed_expressions[key]
+
     if_loop = False
 
     tab = '  '
@@ -260,11 +359,12 @@ def parse_gui_expression(expression,
                                                    loop_tokens,
                                                    need_for_loop)
 
-    for exp in expr_user:
-        usr_defs += indent_decl*tab + exp
+    usr_defs = ''.join([indent_decl*tab + exp for exp in expr_user])
+    usr_code = ''.join([ntabs*tab + exp for exp in expr_list])
 
-    for exp in expr_list:
-        usr_code += ntabs*tab + exp
+    if len(_parsed_expressions) >= _parsed_expressions_max_size:
+        del _parsed_expressions[next(iter(_parsed_expressions))]
+    _parsed_expressions[key] = (usr_code, usr_defs)
 
     return usr_code, usr_defs
 
@@ -274,17 +374,110 @@ def parse_gui_expression(expression,
 
 def break_expression(exp):
 
-    expression_lines = []
+    # Split each line into its set of components (whitespace-separated
+    # once separators are translated, which also strips empty components).
+    # Only membership of components is tested, so order is not kept.
+
+    return [frozenset(line.translate(_expression_separators).split())
+            for line in exp.split('\n')]
+
+#-------------------------------------------------------------------------------
+
+def expression_names(exp):
+
+    # Set of tokens of an expression, as seen by the parser when resolving
+    # symbols (so that comments are excluded, and names adjacent to any
+    # separator or comment marker are found). Tokenization is cached.
+
+    tokens, comments = cs_math_parser().tokenize_expression(exp)
+
+    return frozenset([t[0] for t in tokens])
+
+#-------------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=128)
+def dashes(n):
 
-    for line in exp.split('\n'):
-        line_comp = []
-        for elt in re.split('=|\+|-|\*|\/|\(|\)|;|,|\^|<|>|\&\&|\|\|',line):
-            if elt != '':
-                line_comp.append(elt.strip())
+    # Run of dashes for comment underlines (shared for a given length)
 
-        expression_lines.append(line_comp)
+    return '-'*n
 
-    return expression_lines
+#-------------------------------------------------------------------------------
+
+def block_banner(func_type, func_key):
+
+    # Comment banner preceding a given block in the generated code
+
+    zone_name, var_name = func_key.split('::')
+    var_name = var_name.replace("+", ", ")
+    m1 = _block_comments[func_type] % (var_name, zone_name)
+
+    return _block_banner.format_map({'title': m1.rstrip(),
+                                     'dashes': dashes(len(m1))})
+
+#-------------------------------------------------------------------------------
+
+def block_signature(func_key, func_params):
+
+    # Signature of the inputs a generated block depends on, used to
+    # reuse a previously rendered block when its formula is unchanged.
+    # The tuple itself is compared (not its hash), so that distinct inputs
+    # can never match; lists are represented as strings so that later
+    # changes to them are detected.
+
+    return (func_key,
+            func_params.exp,
+            repr(func_params.req),
+            repr(func_params.sym),
+            repr(func_params.knf),
+            func_params.cnd,
+            func_params.tpe,
+            func_params.elt)
+
+#===============================================================================
+# Formula block description
+#===============================================================================
+
+class meg_function_block:
+
+    # Description of a given formula (expression, required and known
+    # symbols, ...) and of its last generated code.
+
+    __slots__ = ('exp', 'req', 'req_names', 'sym', 'knf', 'cnd', 'tpe', 'elt',
+                 'banner', 'sig', 'rendered')
+
+    def __init__(self,
+                 expression,
+                 required,
+                 symbols,
+                 known_fields,
+                 condition = None,
+                 source_type = None,
+                 element_type = "center"):
+
+        self.exp = expression
+        self.req = required
+        self.sym = symbols
+        self.knf = known_fields
+        self.cnd = condition
+        self.tpe = source_type
+        self.elt = element_type
+        if self.elt not in ('center', 'vertex'):
+            self.elt = 'center'
+
+        # Required names (GUI editors pass (name, description) tuples)
+        if required and isinstance(required[0], tuple):
+            self.req_names = [r[0] for r in required]
+        else:
+            self.req_names = required
+
+        # Comment banner preceding the generated block (set by the caller,
+        # as it depends on the function type and key)
+        self.banner = ''
+
+        # Signature of inputs and generated code of last written block
+        self.sig = None
+        self.rendered = None
 
 #===============================================================================
 # Main class
@@ -315,6 +508,15 @@ class meg_to_c_interpreter:
 
         self.tmp_path = os.path.join(data_path, 'tmp')
 
+        # package-specific fluid properties
+        self.fluid_props = _pkg_fluid_prop_dict[self.module_name]
+        self.glob_struct = _pkg_glob_struct[self.module_name]
+        self.fluid_prop_keys = frozenset(self.fluid_props)
+        self._fluid_prop_tokens = {}
+
+        # boundary condition models, shared by boundary code generators
+        self._boundaries = {}
+
         # function name to file name dictionary
         self.funcs = {'vol': {},
                       'bnd': {},
@@ -325,12 +527,32 @@ class meg_to_c_interpreter:
                       'pfl': {},
                       'pwa': {}}
 
-        self.code_to_write = ""
+        # block writer for each function type
+        self.block_writers = {'vol': self.write_cell_block,
+                              'bnd': self.write_bnd_block,
+                              'src': self.write_src_block,
+                              'ini': self.write_ini_block,
+                              'ibm': self.write_ibm_block,
+                              'fsi': self.write_fsi_block,
+                              'pfl': self.write_profile_coo_block,
+                              'pwa': self.write_writer_activation_block}
+
+        from code_saturne.model.NotebookModel import NotebookModel
+        from code_saturne.model.TimeTablesModel import TimeTablesModel
 
+        # Notebook variables and matching symbols and definitions
+        # (built once per case, as they are used for most formulas)
         nb = NotebookModel(self.case)
         self.notebook = {}
+        self.notebook_symbols = []
+        self.notebook_tokens = {}
         for (nme, val) in nb.getNotebookList():
             self.notebook[nme] = str(val)
+            self.notebook_symbols.append((nme,
+                                          'value (notebook) = ' + str(val)))
+            self.notebook_tokens[nme] = \
+            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (nme, nme)
+        self.notebook_keys = frozenset(self.notebook_tokens)
 
         TTM = TimeTablesModel(self.case)
         self.time_tables = {}
@@ -340,6 +562,13 @@ class meg_to_c_interpreter:
                 self.time_tables[_k] = ['{}_{}'.format(tab_name,_h),
                                         'CS_TIME_TABLE("{}","{}")'.format(tab_name, _h)]
 
+        # Time table references matcher ("table[header]" names, longest first),
+        # so that they may all be replaced in a single pass.
+        self.time_tables_re = None
+        if self.time_tables:
+            _tt_keys = sorted(self.time_tables.keys(), key=len, reverse=True)
+            self.time_tables_re = \
+                re.compile(r'(?<!\w)(?:' + '|'.join(map(re.escape, _tt_keys)) + ')')
 
         if create_functions and getRunType(self.case) == 'standard':
 
@@ -374,10 +603,88 @@ class meg_to_c_interpreter:
 
     #---------------------------------------------------------------------------
 
+    def fluid_prop_tokens(self, phase_id):
+
+        # Definitions of reference fluid properties for a given phase
+        # (built once per phase, as they are shared by all formulas)
+
+        if phase_id not in self._fluid_prop_tokens:
+            gs = self.glob_struct.replace('PHASE_ID', str(phase_id))
+            self._fluid_prop_tokens[phase_id] = \
+                {kp: 'const cs_real_t %s = %s->%s;' % (kp, gs, pn)
+                 for kp, pn in self.fluid_props.items()}
+
+        return self._fluid_prop_tokens[phase_id]
+
+    #---------------------------------------------------------------------------
+
+    def referenced_fluid_prop_tokens(self, phase_id, exp_names):
+
+        # Definitions of the reference fluid properties appearing
+        # in an expression
+
+        used = self.fluid_prop_keys & exp_names
+        if not used:
+            return {}
+
+        fp_tokens = self.fluid_prop_tokens(phase_id)
+
+        return {kp: fp_tokens[kp] for kp in sorted(used)}
+
+    #---------------------------------------------------------------------------
+
+    def referenced_notebook_tokens(self, exp_names):
+
+        # Definitions of the notebook variables appearing in an expression
+        # (usually few or none, so avoid adding all of them to each block)
+
+        if not self.notebook_keys:
+            return {}
+
+        used = self.notebook_keys & exp_names
+
+        return {nb: self.notebook_tokens[nb] for nb in sorted(used)}
+
+    #---------------------------------------------------------------------------
+
+    def get_boundary(self, nature, label, *args):
+
+        # Boundary conditions model for a given zone (and field for
+        # neptune_cfd), built once as it is queried for many variables.
+
+        key = (nature, label) + args
+        boundary = self._boundaries.get(key)
+
+        if boundary is None:
+            if self.module_name == 'code_saturne':
+                from code_saturne.model.Boundary import Boundary
+            else:
+                from code_saturne.model.BoundaryNeptune import Boundary
+            boundary = Boundary(nature, label, self.case, *args)
+            self._boundaries[key] = boundary
+
+        return boundary
+
+    #---------------------------------------------------------------------------
+
+    def replace_time_tables(self, code):
+
+        # Replace "table[header]" references by the matching local variables
+
+        if self.time_tables_re is None:
+            return code
+
+        return self.time_tables_re.sub(lambda m: self.time_tables[m.group(0)][0],
+                                       code)
+
+    #---------------------------------------------------------------------------
+
     def update_block_expression(self, func_type, key, new_exp):
 
-        self.funcs[func_type][key]['exp']   = new_exp
-        self.funcs[func_type][key]['lines'] = break_expression(new_exp)
+        func_params = self.funcs[func_type][key]
+
+        func_params.exp      = new_exp
+        func_params.rendered = None
 
     #---------------------------------------------------------------------------
 
@@ -398,20 +705,17 @@ class meg_to_c_interpreter:
         if fkey in self.funcs[ftype].keys():
             msg = 'Formula for "%s" in %s %s was already defined:\n %s' \
                     % (name, _func_short_to_long[ftype], zone_name,
-                       self.funcs[ftype][fkey]['exp'])
+                       self.funcs[ftype][fkey].exp)
             raise Exception(msg)
 
-        self.funcs[ftype][fkey] = {'exp': expression,
-                                   'req': required,
-                                   'sym': symbols,
-                                   'knf': known_fields,
-                                   'cnd': condition,
-                                   'tpe': source_type,
-                                   'elt': element_type}
-        if self.funcs[ftype][fkey]['elt'] not in ('center', 'vertex'):
-            self.funcs[ftype][fkey]['elt'] = 'center'
-
-        self.funcs[ftype][fkey]['lines'] = break_expression(expression)
+        self.funcs[ftype][fkey] = meg_function_block(expression,
+                                                     required,
+                                                     symbols,
+                                                     known_fields,
+                                                     condition,
+                                                     source_type,
+                                                     element_type)
+        self.funcs[ftype][fkey].banner = block_banner(ftype, fkey)
 
     #---------------------------------------------------------------------------
 
@@ -419,60 +723,42 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['vol'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
-        known_fields = func_params['knf']
+        expression   = func_params.exp
+        symbols      = func_params.sym
+        known_fields = func_params.knf
 
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        required = func_params.req_names
 
         zone, name = func_key.split('::')
-        exp_lines_comp = func_params['lines']
-
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
+        exp_names = expression_names(expression)
 
         tab   = "  "
         ntabs = 2
 
         known_symbols = []
-        coords = ['x', 'y', 'z']
         need_coords = False
 
         # ------------------------
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
-        loop_tokens = {}
-        glob_tokens.update(_base_tokens)
+        glob_tokens = dict(_base_tokens)
 
         # Coordinates
-        for kc in coords:
-            ic = coords.index(kc)
-            loop_tokens[kc] = 'const cs_real_t %s = xyz[c_id][%s];' % (kc, str(ic))
+        loop_tokens = dict(_cell_coord_tokens)
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # fluid properties
-        for kp in _pkg_fluid_prop_dict[self.module_name].keys():
-            if len(name.split("_")) > 1:
-                try:
-                    phase_id = int(name.split('_')[-1])-1
-                except:
-                    phase_id = -1
-            else:
+        if len(name.split("_")) > 1:
+            try:
+                phase_id = int(name.split('_')[-1])-1
+            except:
                 phase_id = -1
-            gs = _pkg_glob_struct[self.module_name].replace('PHASE_ID',
-                                                            str(phase_id))
-            pn = _pkg_fluid_prop_dict[self.module_name][kp]
-            glob_tokens[kp] = 'const cs_real_t %s = %s->%s;' %(kp, gs, pn)
+        else:
+            phase_id = -1
+        glob_tokens.update(self.referenced_fluid_prop_tokens(phase_id,
+                                                             exp_names))
 
         if name[-12:] == '_diffusivity':
             name_ref = name + '_ref'
@@ -518,35 +804,34 @@ class meg_to_c_interpreter:
 
         ntabs += 1
 
-        # Parse the user expression
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'vol',
-                                          glob_tokens,
-                                          loop_tokens,
-                                          need_for_loop=True)
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
+        # Parse the user expression (get user code and definitions)
+        usr_code, usr_defs = parse_gui_expression(expression,
+                                                  required,
+                                                  known_symbols,
+                                                  'vol',
+                                                  glob_tokens,
+                                                  loop_tokens,
+                                                  need_for_loop=True)
 
         # Write the block
         nsplit = name.split('+')
-        usr_blck = tab + 'if (strcmp(f[0]->name, "%s") == 0 &&\n' % (nsplit[0])
+        usr_blck = [tab + 'if (strcmp(f[0]->name, "%s") == 0 &&\n' % (nsplit[0])]
         for i in range(1,len(nsplit)):
-            usr_blck += tab + '    strcmp(f[%d]->name, "%s") == 0 &&\n' % (i, nsplit[i])
+            usr_blck.append(tab + '    strcmp(f[%d]->name, "%s") == 0 &&\n' % (i, nsplit[i]))
+
+        usr_blck.append(tab + '    strcmp(zone_name, "%s") == 0) {\n' % (zone))
 
-        usr_blck += tab + '    strcmp(zone_name, "%s") == 0) {\n' % (zone)
+        usr_blck.append(usr_defs)
 
-        usr_blck += usr_defs
+        usr_blck.append(2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n')
+        usr_blck.append(3*tab + 'cs_lnum_t c_id = elt_ids[e_id];\n')
 
-        usr_blck += 2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n'
-        usr_blck += 3*tab + 'cs_lnum_t c_id = elt_ids[e_id];\n'
+        usr_blck.append(usr_code)
 
-        usr_blck += usr_code
+        usr_blck.append(2*tab + '}\n')
+        usr_blck.append(tab + '}\n')
 
-        usr_blck += 2*tab + '}\n'
-        usr_blck += tab + '}\n'
+        usr_blck = ''.join(usr_blck)
 
         return usr_blck
 
@@ -559,18 +844,15 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['bnd'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
-        known_fields = func_params['knf']
-        cname        = func_params['cnd']
-        element_type = func_params['elt']
+        expression   = func_params.exp
+        symbols      = func_params.sym
+        known_fields = func_params.knf
+        cname        = func_params.cnd
+        element_type = func_params.elt
 
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        required = func_params.req_names
 
-        exp_lines_comp = func_params['lines']
+        exp_names = expression_names(expression)
 
         zone, field_name = func_key.split('::')
 
@@ -579,10 +861,8 @@ class meg_to_c_interpreter:
         if cname == 'flow1_formula' or cname == 'flow2_formula':
             need_for_loop = False
 
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
+        # Get user definitions
+        usr_defs = []
 
         tab   = "  "
         ntabs = 2
@@ -591,7 +871,6 @@ class meg_to_c_interpreter:
         for req in required:
             known_symbols.append(req)
 
-        coords = ['x', 'y', 'z']
         need_coords = False
 
         # allocate the new array
@@ -620,31 +899,24 @@ class meg_to_c_interpreter:
 #                usr_defs += ntabs*tab + '%s&%s,\n' % (b_f_vtx_sel_tab, val_str)
 #                usr_defs += ntabs*tab + '%s%s);\n' % (b_f_vtx_sel_tab, ids_str)
 #
-            usr_defs += ntabs*tab + 'const cs_lnum_t vals_size = n_elts * %d;\n' \
-                    % (len(required))
+            usr_defs.append(ntabs*tab + 'const cs_lnum_t vals_size = n_elts * %d;\n' \
+                            % (len(required)))
         else:
-            usr_defs += ntabs*tab + 'const cs_lnum_t vals_size = %d;\n' % (len(required))
+            usr_defs.append(ntabs*tab + 'const cs_lnum_t vals_size = %d;\n' % (len(required)))
 
-        usr_defs += ntabs*tab + 'BFT_MALLOC(new_vals, vals_size, cs_real_t);\n'
-        usr_defs += '\n'
+        usr_defs.append(ntabs*tab + 'BFT_MALLOC(new_vals, vals_size, cs_real_t);\n')
+        usr_defs.append('\n')
 
         # ------------------------
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
-        loop_tokens = {}
-        glob_tokens.update(_base_tokens)
+        glob_tokens = dict(_base_tokens)
 
         # Coordinates
-        for kc in coords:
-            ic = coords.index(kc)
-            loop_tokens[kc] = 'const cs_real_t %s = xyz[b_e_id][%s];' \
-                    % (kc, str(ic))
+        loop_tokens = dict(_bnd_coord_tokens)
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # Time table variables
         for ktt in self.time_tables.keys():
@@ -665,40 +937,39 @@ class meg_to_c_interpreter:
             ntabs += 1
 
         # Parse the user expression
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'bnd',
-                                          glob_tokens,
-                                          loop_tokens,
-                                          need_for_loop)
-
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
+        usr_code, parsed_defs = parse_gui_expression(expression,
+                                                     required,
+                                                     known_symbols,
+                                                     'bnd',
+                                                     glob_tokens,
+                                                     loop_tokens,
+                                                     need_for_loop)
+
+        usr_defs.append(parsed_defs)
 
         # Write the block
-        block_cond  = tab + 'if (strcmp(field_name, "%s") == 0 &&\n' % (field_name)
-        block_cond += tab + '    strcmp(condition, "%s") == 0 &&\n' % (cname)
-        block_cond += tab + '    strcmp(zone_name, "%s") == 0) {\n' % (zone)
-        usr_blck = block_cond + '\n'
+        usr_blck = [tab + 'if (strcmp(field_name, "%s") == 0 &&\n' % (field_name),
+                    tab + '    strcmp(condition, "%s") == 0 &&\n' % (cname),
+                    tab + '    strcmp(zone_name, "%s") == 0) {\n' % (zone),
+                    '\n']
 
-        usr_blck += usr_defs
+        usr_blck.extend(usr_defs)
 
         if need_for_loop:
-            usr_blck += 2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n'
-            usr_blck += 3*tab + 'cs_lnum_t b_e_id = elt_ids[e_id];\n'
+            usr_blck.append(2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n')
+            usr_blck.append(3*tab + 'cs_lnum_t b_e_id = elt_ids[e_id];\n')
 
-        usr_blck += usr_code
+        usr_blck.append(usr_code)
 
         if need_for_loop:
-            usr_blck += 2*tab + '}\n'
+            usr_blck.append(2*tab + '}\n')
 
-        usr_blck += tab + '}\n'
+        usr_blck.append(tab + '}\n')
+
+        usr_blck = ''.join(usr_blck)
 
         # Replace time table calls
-        for _tt in self.time_tables.keys():
-            usr_blck = usr_blck.replace(_tt, self.time_tables[_tt][0])
+        usr_blck = self.replace_time_tables(usr_blck)
 
         return usr_blck
 
@@ -712,47 +983,37 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['src'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
+        expression   = func_params.exp
+        symbols      = func_params.sym
 
-        known_fields = dict( zip([k[0] for k in func_params['knf']],
-                                 [k[1] for k in func_params['knf']]))
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        known_fields = dict( zip([k[0] for k in func_params.knf],
+                                 [k[1] for k in func_params.knf]))
+        required = func_params.req_names
 
-        source_type  = func_params['tpe']
+        source_type  = func_params.tpe
 
         zone, name = func_key.split('::')
-        exp_lines_comp = func_params['lines']
+        exp_names = expression_names(expression)
 
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
+        # Get user definitions
+        usr_defs = []
 
         tab   = '  '
         ntabs = 2
 
-        usr_defs += ntabs*tab + 'const cs_lnum_t vals_size = n_elts * %d;\n' % (len(required))
-        usr_defs += ntabs*tab + 'BFT_MALLOC(new_vals, vals_size, cs_real_t);\n'
-        usr_defs += '\n'
+        usr_defs.append(ntabs*tab + 'const cs_lnum_t vals_size = n_elts * %d;\n' % (len(required)))
+        usr_defs.append(ntabs*tab + 'BFT_MALLOC(new_vals, vals_size, cs_real_t);\n')
+        usr_defs.append('\n')
 
         known_symbols = []
-        coords = ['x', 'y', 'z']
 
         # ------------------------
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
-        loop_tokens = {}
-        glob_tokens.update(_base_tokens)
+        glob_tokens = dict(_base_tokens)
 
         # Coordinates
-        for kc in coords:
-            ic = coords.index(kc)
-            loop_tokens[kc] = 'const cs_real_t %s = xyz[c_id][%s];' % (kc, str(ic))
+        loop_tokens = dict(_cell_coord_tokens)
 
         # For momentum also define u,v and w:
         if source_type == "momentum_source_term":
@@ -763,9 +1024,7 @@ class meg_to_c_interpreter:
                 'const cs_real_t %s = vel[c_id][%d];' % (key, i)
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # Time table variables
         for ktt in self.time_tables.keys():
@@ -788,37 +1047,36 @@ class meg_to_c_interpreter:
             known_symbols.append(r)
 
         # Parse the user expression
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'src',
-                                          glob_tokens,
-                                          loop_tokens,
-                                          need_for_loop=True)
-
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
+        usr_code, parsed_defs = parse_gui_expression(expression,
+                                                     required,
+                                                     known_symbols,
+                                                     'src',
+                                                     glob_tokens,
+                                                     loop_tokens,
+                                                     need_for_loop=True)
+
+        usr_defs.append(parsed_defs)
 
         # Write the block
-        block_cond  = tab + 'if (strcmp(zone_name, "%s") == 0 &&\n' % (zone)
-        block_cond += tab + '    strcmp(name, "%s") == 0 && \n' % (name)
-        block_cond += tab + '    strcmp(source_type, "%s") == 0) {\n' % (source_type)
-        usr_blck = block_cond + '\n'
+        usr_blck = [tab + 'if (strcmp(zone_name, "%s") == 0 &&\n' % (zone),
+                    tab + '    strcmp(name, "%s") == 0 && \n' % (name),
+                    tab + '    strcmp(source_type, "%s") == 0) {\n' % (source_type),
+                    '\n']
+
+        usr_blck.extend(usr_defs)
 
-        usr_blck += usr_defs
+        usr_blck.append(2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n')
+        usr_blck.append(3*tab + 'cs_lnum_t c_id = elt_ids[e_id];\n')
 
-        usr_blck += 2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n'
-        usr_blck += 3*tab + 'cs_lnum_t c_id = elt_ids[e_id];\n'
+        usr_blck.append(usr_code)
 
-        usr_blck += usr_code
+        usr_blck.append(2*tab + '}\n')
+        usr_blck.append(tab + '}\n')
 
-        usr_blck += 2*tab + '}\n'
-        usr_blck += tab + '}\n'
+        usr_blck = ''.join(usr_blck)
 
         # Replace time table calls
-        for _tt in self.time_tables.keys():
-            usr_blck = usr_blck.replace(_tt, self.time_tables[_tt][0])
+        usr_blck = self.replace_time_tables(usr_blck)
 
         return usr_blck
 
@@ -832,63 +1090,47 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['ini'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
-        known_fields = func_params['knf']
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        expression   = func_params.exp
+        symbols      = func_params.sym
+        known_fields = func_params.knf
+        required = func_params.req_names
 
         zone, name = func_key.split('::')
-        exp_lines_comp = func_params['lines']
+        exp_names = expression_names(expression)
 
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
+        # Get user definitions
+        usr_defs = []
 
         tab   = '  '
         ntabs = 2
 
-        usr_defs += ntabs*tab + 'const cs_lnum_t vals_size = n_elts * %d;\n' % (len(required))
-        usr_defs += ntabs*tab + 'BFT_MALLOC(new_vals, vals_size, cs_real_t);\n'
-        usr_defs += '\n'
+        usr_defs.append(ntabs*tab + 'const cs_lnum_t vals_size = n_elts * %d;\n' % (len(required)))
+        usr_defs.append(ntabs*tab + 'BFT_MALLOC(new_vals, vals_size, cs_real_t);\n')
+        usr_defs.append('\n')
 
         known_symbols = []
-        coords = ['x', 'y', 'z']
 
         # ------------------------
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
-        loop_tokens = {}
-        glob_tokens.update(_base_tokens)
+        glob_tokens = dict(_base_tokens)
 
         # Coordinates
-        for kc in coords:
-            ic = coords.index(kc)
-            loop_tokens[kc] = 'const cs_real_t %s = xyz[c_id][%s];' % (kc, str(ic))
+        loop_tokens = dict(_cell_coord_tokens)
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # fluid properties
-
-        for kp in _pkg_fluid_prop_dict[self.module_name].keys():
-            if len(name.split("_")) > 1:
-                try:
-                    phase_id = int(name.split('_')[-1])-1
-                except:
-                    phase_id = -1
-            else:
+        if len(name.split("_")) > 1:
+            try:
+                phase_id = int(name.split('_')[-1])-1
+            except:
                 phase_id = -1
-            gs = _pkg_glob_struct[self.module_name].replace('PHASE_ID',
-                                                         str(phase_id))
-            pn = _pkg_fluid_prop_dict[self.module_name][kp]
-            glob_tokens[kp] = 'const cs_real_t %s = %s->%s;' %(kp, gs, pn)
+        else:
+            phase_id = -1
+        glob_tokens.update(self.referenced_fluid_prop_tokens(phase_id,
+                                                             exp_names))
 
         # known fields
 
@@ -904,34 +1146,32 @@ class meg_to_c_interpreter:
             known_symbols.append(r)
 
         # Parse the user expresion
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'ini',
-                                          glob_tokens,
-                                          loop_tokens,
-                                          need_for_loop=True)
-
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
+        usr_code, parsed_defs = parse_gui_expression(expression,
+                                                     required,
+                                                     known_symbols,
+                                                     'ini',
+                                                     glob_tokens,
+                                                     loop_tokens,
+                                                     need_for_loop=True)
+
+        usr_defs.append(parsed_defs)
 
         # Write the block
-        block_cond  = tab + 'if (strcmp(zone_name, "%s") == 0 &&\n' % (zone)
-        block_cond += tab + '    strcmp(field_name, "%s") == 0) {\n' % (name)
-        usr_blck = block_cond + '\n'
+        usr_blck = [tab + 'if (strcmp(zone_name, "%s") == 0 &&\n' % (zone),
+                    tab + '    strcmp(field_name, "%s") == 0) {\n' % (name),
+                    '\n']
 
-        usr_blck += usr_defs
+        usr_blck.extend(usr_defs)
 
-        usr_blck += 2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n'
-        usr_blck += 3*tab + 'cs_lnum_t c_id = elt_ids[e_id];\n'
+        usr_blck.append(2*tab + 'for (cs_lnum_t e_id = 0; e_id < n_elts; e_id++) {\n')
+        usr_blck.append(3*tab + 'cs_lnum_t c_id = elt_ids[e_id];\n')
 
-        usr_blck += usr_code
+        usr_blck.append(usr_code)
 
-        usr_blck += 2*tab + '}\n'
-        usr_blck += tab + '}\n'
+        usr_blck.append(2*tab + '}\n')
+        usr_blck.append(tab + '}\n')
 
-        return usr_blck
+        return ''.join(usr_blck)
 
     #---------------------------------------------------------------------------
 
@@ -939,48 +1179,33 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['ibm'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
-        known_fields = func_params['knf']
+        expression   = func_params.exp
+        symbols      = func_params.sym
+        known_fields = func_params.knf
 
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        required = func_params.req_names
 
         object_name, name = func_key.split('::')
-        exp_lines_comp = func_params['lines']
-
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
+        exp_names = expression_names(expression)
 
         tab   = "  "
         ntabs = 2
 
         known_symbols = []
-        coords = ['x', 'y', 'z']
 
         # ------------------------
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
-        loop_tokens = {}
-        glob_tokens.update(_base_tokens)
+        glob_tokens = dict(_base_tokens)
 
         # Coordinates
-        for kc in coords:
-            ic = coords.index(kc)
-            loop_tokens[kc] = 'const cs_real_t %s = xyz[c_id][%s];' % (kc, str(ic))
+        loop_tokens = dict(_cell_coord_tokens)
 
         glob_tokens['xyz'] = \
         'const cs_real_3_t *xyz = (cs_real_3_t *)cs_glob_mesh_quantities->cell_cen;'
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # ------------------------
 
@@ -993,24 +1218,20 @@ class meg_to_c_interpreter:
         if_loop = False
 
         # Parse the user expresion
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'ibm',
-                                          glob_tokens,
-                                          loop_tokens)
-
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
-
-        usr_blck = tab + 'if (strcmp(object_name, "%s") == 0) {' % (name)
+        usr_code, usr_defs = parse_gui_expression(expression,
+                                                  required,
+                                                  known_symbols,
+                                                  'ibm',
+                                                  glob_tokens,
+                                                  loop_tokens)
+
+        usr_blck = [tab + 'if (strcmp(object_name, "%s") == 0) {' % (name)]
         if usr_defs != '':
-            usr_blck += usr_defs + '\n'
-        usr_blck += usr_code
-        usr_blck += tab + '}\n'
+            usr_blck.append(usr_defs + '\n')
+        usr_blck.append(usr_code)
+        usr_blck.append(tab + '}\n')
 
-        return usr_blck
+        return ''.join(usr_blck)
 
     #---------------------------------------------------------------------------
 
@@ -1021,25 +1242,17 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['fsi'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
-        known_fields = func_params['knf']
-        cname        = func_params['cnd']
+        expression   = func_params.exp
+        symbols      = func_params.sym
+        known_fields = func_params.knf
+        cname        = func_params.cnd
 
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        required = func_params.req_names
 
-        exp_lines_comp = func_params['lines']
+        exp_names = expression_names(expression)
 
         zone, mat_name = func_key.split('::')
 
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
-
         tab   = "  "
         ntabs = 2
 
@@ -1048,73 +1261,66 @@ class meg_to_c_interpreter:
             known_symbols.append(req)
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
+        glob_tokens = dict(_base_tokens)
         loop_tokens = {}
-        glob_tokens.update(_base_tokens)
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # Parse the user expresion
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'fsi',
-                                          glob_tokens,
-                                          loop_tokens,
-                                          indent_decl=3)
-
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
+        usr_code, usr_defs = parse_gui_expression(expression,
+                                                  required,
+                                                  known_symbols,
+                                                  'fsi',
+                                                  glob_tokens,
+                                                  loop_tokens,
+                                                  indent_decl=3)
 
         # Write the block
-        block_cond  = tab + 'if (   strcmp(object_type, "%s") == 0\n' % (mat_name)
-        block_cond += tab + '    && strcmp(name, "%s") == 0) {\n' % (zone)
-        usr_blck = block_cond + '\n'
+        usr_blck = [tab + 'if (   strcmp(object_type, "%s") == 0\n' % (mat_name),
+                    tab + '    && strcmp(name, "%s") == 0) {\n' % (zone),
+                    '\n']
         set_blck = '    }\n\n'
 
         if mat_name == "mass_matrix":
-            usr_blck += '    cs_real_t m11 = 0, m12 = 0, m13 = 0;\n'
-            usr_blck += '    cs_real_t m21 = 0, m22 = 0, m23 = 0;\n'
-            usr_blck += '    cs_real_t m31 = 0, m32 = 0, m33 = 0;\n\n'
+            usr_blck.append('    cs_real_t m11 = 0, m12 = 0, m13 = 0;\n')
+            usr_blck.append('    cs_real_t m21 = 0, m22 = 0, m23 = 0;\n')
+            usr_blck.append('    cs_real_t m31 = 0, m32 = 0, m33 = 0;\n\n')
             set_blck += '    val[0] = m11; val[1] = m12; val[2] = m13;\n'
             set_blck += '    val[3] = m21; val[4] = m22; val[5] = m23;\n'
             set_blck += '    val[6] = m31; val[7] = m32; val[8] = m33;\n'
         elif mat_name == "stiffness_matrix":
-            usr_blck += '    cs_real_t k11 = 0, k12 = 0, k13 = 0;\n'
-            usr_blck += '    cs_real_t k21 = 0, k22 = 0, k23 = 0;\n'
-            usr_blck += '    cs_real_t k31 = 0, k32 = 0, k33 = 0;\n\n'
+            usr_blck.append('    cs_real_t k11 = 0, k12 = 0, k13 = 0;\n')
+            usr_blck.append('    cs_real_t k21 = 0, k22 = 0, k23 = 0;\n')
+            usr_blck.append('    cs_real_t k31 = 0, k32 = 0, k33 = 0;\n\n')
             set_blck += '    val[0] = k11; val[1] = k12; val[2] = k13;\n'
             set_blck += '    val[3] = k21; val[4] = k22; val[5] = k23;\n'
             set_blck += '    val[6] = k31; val[7] = k32; val[8] = k33;\n'
         elif mat_name == "damping_matrix":
-            usr_blck += '    cs_real_t c11 = 0, c12 = 0, c13 = 0;\n'
-            usr_blck += '    cs_real_t c21 = 0, c22 = 0, c23 = 0;\n'
-            usr_blck += '    cs_real_t c31 = 0, c32 = 0, c33 = 0;\n\n'
+            usr_blck.append('    cs_real_t c11 = 0, c12 = 0, c13 = 0;\n')
+            usr_blck.append('    cs_real_t c21 = 0, c22 = 0, c23 = 0;\n')
+            usr_blck.append('    cs_real_t c31 = 0, c32 = 0, c33 = 0;\n\n')
             set_blck += '    val[0] = c11; val[1] = c12; val[2] = c13;\n'
             set_blck += '    val[3] = c21; val[4] = c22; val[5] = c23;\n'
             set_blck += '    val[6] = c31; val[7] = c32; val[8] = c33;\n'
         elif mat_name == "fluid_force":
-            usr_blck += '    cs_real_t fluid_fx = fluid_f[0];\n'
-            usr_blck += '    cs_real_t fluid_fy = fluid_f[1];\n'
-            usr_blck += '    cs_real_t fluid_fz = fluid_f[2];\n'
-            usr_blck += '    cs_real_t fx = 0, fy = 0, fz = 0;\n'
+            usr_blck.append('    cs_real_t fluid_fx = fluid_f[0];\n')
+            usr_blck.append('    cs_real_t fluid_fy = fluid_f[1];\n')
+            usr_blck.append('    cs_real_t fluid_fz = fluid_f[2];\n')
+            usr_blck.append('    cs_real_t fx = 0, fy = 0, fz = 0;\n')
             set_blck += '    val[0] = fx; val[1] = fy; val[2] = fz;\n'
 
-        usr_blck += '    {\n'
+        usr_blck.append('    {\n')
 
-        usr_blck += usr_defs
+        usr_blck.append(usr_defs)
 
-        usr_blck += usr_code
+        usr_blck.append(usr_code)
 
-        usr_blck += set_blck
+        usr_blck.append(set_blck)
 
-        usr_blck += tab + '}\n'
+        usr_blck.append(tab + '}\n')
 
-        return usr_blck
+        return ''.join(usr_blck)
 
     #---------------------------------------------------------------------------
 
@@ -1125,25 +1331,17 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['pfl'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
-        known_fields = func_params['knf']
-        cname        = func_params['cnd']
+        expression   = func_params.exp
+        symbols      = func_params.sym
+        known_fields = func_params.knf
+        cname        = func_params.cnd
 
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        required = func_params.req_names
 
-        exp_lines_comp = func_params['lines']
+        exp_names = expression_names(expression)
 
         name, s = func_key.split('::')
 
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
-
         tab   = "  "
         ntabs = 2
 
@@ -1152,45 +1350,38 @@ class meg_to_c_interpreter:
             known_symbols.append(req)
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
+        glob_tokens = dict(_base_tokens)
         loop_tokens = {}
-        glob_tokens.update(_base_tokens)
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # Parse the user expresion
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'pwa',
-                                          glob_tokens,
-                                          loop_tokens,
-                                          indent_decl=2)
-
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
+        usr_code, usr_defs = parse_gui_expression(expression,
+                                                  required,
+                                                  known_symbols,
+                                                  'pwa',
+                                                  glob_tokens,
+                                                  loop_tokens,
+                                                  indent_decl=2)
 
         # Write the block
-        usr_blck =  tab + 'if (strcmp(name, "%s") == 0) {\n' % (name)
-        usr_blck += usr_defs
-        usr_blck += tab + '  cs_real_t x, y, z;\n\n'
-        usr_blck += tab + '  for (int p_id = 0; p_id < n_coords; p_id++) {\n'
-        usr_blck += tab + '    cs_real_t s = (cs_real_t)p_id / (cs_real_t)(n_coords-1);\n\n'
+        usr_blck = [tab + 'if (strcmp(name, "%s") == 0) {\n' % (name)]
+        usr_blck.append(usr_defs)
+        usr_blck.append(tab + '  cs_real_t x, y, z;\n\n')
+        usr_blck.append(tab + '  for (int p_id = 0; p_id < n_coords; p_id++) {\n')
+        usr_blck.append(tab + '    cs_real_t s = (cs_real_t)p_id / (cs_real_t)(n_coords-1);\n\n')
 
-        usr_blck += usr_code
+        usr_blck.append(usr_code)
 
-        usr_blck += '\n'
-        usr_blck += tab + '    coords[p_id][0] = x;\n'
-        usr_blck += tab + '    coords[p_id][1] = y;\n'
-        usr_blck += tab + '    coords[p_id][2] = z;\n'
-        usr_blck += tab*2 + '}\n'
-        usr_blck += tab + '}\n'
+        usr_blck.append('\n')
+        usr_blck.append(tab + '    coords[p_id][0] = x;\n')
+        usr_blck.append(tab + '    coords[p_id][1] = y;\n')
+        usr_blck.append(tab + '    coords[p_id][2] = z;\n')
+        usr_blck.append(tab*2 + '}\n')
+        usr_blck.append(tab + '}\n')
 
-        return usr_blck
+        return ''.join(usr_blck)
 
     #---------------------------------------------------------------------------
 
@@ -1201,25 +1392,17 @@ class meg_to_c_interpreter:
 
         func_params = self.funcs['pwa'][func_key]
 
-        expression   = func_params['exp']
-        symbols      = func_params['sym']
-        known_fields = func_params['knf']
-        cname        = func_params['cnd']
+        expression   = func_params.exp
+        symbols      = func_params.sym
+        known_fields = func_params.knf
+        cname        = func_params.cnd
 
-        if type(func_params['req'][0]) == tuple:
-            required = [r[0] for r in func_params['req']]
-        else:
-            required = func_params['req']
+        required = func_params.req_names
 
-        exp_lines_comp = func_params['lines']
+        exp_names = expression_names(expression)
 
         w_id, s = func_key.split('::')
 
-        # Get user definitions and code
-        usr_defs = ''
-        usr_code = ''
-        usr_blck = ''
-
         tab   = "  "
         ntabs = 2
 
@@ -1228,44 +1411,37 @@ class meg_to_c_interpreter:
             known_symbols.append(req)
 
         # Deal with tokens which require a definition
-        glob_tokens = {}
+        glob_tokens = dict(_base_tokens)
         loop_tokens = {}
-        glob_tokens.update(_base_tokens)
 
         # Notebook variables
-        for kn in self.notebook.keys():
-            glob_tokens[kn] = \
-            'const cs_real_t %s = cs_notebook_parameter_value_by_name("%s");' % (kn, kn)
+        glob_tokens.update(self.referenced_notebook_tokens(exp_names))
 
         # Parse the user expresion
-        parsed_exp = parse_gui_expression(expression,
-                                          required,
-                                          known_symbols,
-                                          'pwa',
-                                          glob_tokens,
-                                          loop_tokens,
-                                          indent_decl=3,
-                                          indent_main=4)
-
-        usr_code += parsed_exp[0]
-        if parsed_exp[1] != '':
-            usr_defs += parsed_exp[1]
+        usr_code, usr_defs = parse_gui_expression(expression,
+                                                  required,
+                                                  known_symbols,
+                                                  'pwa',
+                                                  glob_tokens,
+                                                  loop_tokens,
+                                                  indent_decl=3,
+                                                  indent_main=4)
 
         # Write the block
-        usr_blck  = tab + '{\n'
-        usr_blck += tab + '  bool is_active = false;\n\n'
-        usr_blck += tab*2 + '{\n'
+        usr_blck = [tab + '{\n']
+        usr_blck.append(tab + '  bool is_active = false;\n\n')
+        usr_blck.append(tab*2 + '{\n')
 
-        usr_blck += usr_defs
+        usr_blck.append(usr_defs)
 
-        usr_blck += usr_code
+        usr_blck.append(usr_code)
 
-        usr_blck += tab*2 + '}\n'
-        usr_blck += '\n'
-        usr_blck += tab + '  cs_post_activate_writer_if_enabled('+w_id+', is_active);\n'
-        usr_blck += tab + '}\n'
+        usr_blck.append(tab*2 + '}\n')
+        usr_blck.append('\n')
+        usr_blck.append(tab + '  cs_post_activate_writer_if_enabled('+w_id+', is_active);\n')
+        usr_blck.append(tab + '}\n')
 
-        return usr_blck
+        return ''.join(usr_blck)
 
     #---------------------------------------------------------------------------
 
@@ -1275,25 +1451,24 @@ class meg_to_c_interpreter:
         if key not in self.funcs[func_type].keys():
             return
 
-        if func_type == 'vol':
-            return self.write_cell_block(key)
-        elif func_type == 'bnd':
-            return self.write_bnd_block(key)
-        elif func_type == 'src':
-            return self.write_src_block(key)
-        elif func_type == 'ini':
-            return self.write_ini_block(key)
-        elif func_type == 'ibm':
-            return self.write_ibm_block(key)
-        elif func_type == 'fsi':
-            return self.write_fsi_block(key)
-        elif func_type == 'pfl':
-            return self.write_profile_coo_block(key)
-        elif func_type == 'pwa':
-            return self.write_writer_activation_block(key)
-        else:
+        # Reuse previously generated block if inputs are unchanged
+        func_params = self.funcs[func_type][key]
+        sig = block_signature(key, func_params)
+        if func_params.rendered is not None and func_params.sig == sig:
+            return func_params.rendered
+
+        block_writer = self.block_writers.get(func_type)
+        if block_writer is None:
             return None
 
+        w_block = block_writer(key)
+
+        if w_block is not None:
+            func_params.sig = sig
+            func_params.rendered = w_block
+
+        return w_block
+
     #---------------------------------------------------------------------------
 
     def generate_volume_code(self, vol_zones=None):
@@ -1497,26 +1672,25 @@ class meg_to_c_interpreter:
 
     def generate_boundary_code(self):
 
-        from code_saturne.model.NotebookModel import NotebookModel
-
         if self.module_name == 'code_saturne':
             from code_saturne.model.LocalizationModel import LocalizationModel
-            from code_saturne.model.Boundary import Boundary
             from code_saturne.model.TurbulenceModel import TurbulenceModel
 
             blm = LocalizationModel('BoundaryZone', self.case)
             tm = TurbulenceModel(self.case)
 
+            # Turbulence formula block (if any) for the current model
+            turb_block = _bnd_turbulence_blocks.get(tm.getTurbulenceModel())
+
             for zone in blm.getZones():
 
-                boundary = Boundary(zone._nature, zone._label, self.case)
+                boundary = self.get_boundary(zone._nature, zone._label)
 
                 # ALE: imposed mesh velocity
                 c = boundary.getALEChoice()
                 if c == "fixed_velocity":
                     sym = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
-                    for (name, val) in NotebookModel(self.case).getNotebookList():
-                        sym.append((name, 'value (notebook) = ' + str(val)))
+                    sym.extend(self.notebook_symbols)
                     req = ['mesh_velocity[0]', 'mesh_velocity[1]', 'mesh_velocity[2]']
                     exp = boundary.getALEFormula()
 
@@ -1526,8 +1700,7 @@ class meg_to_c_interpreter:
                                     condition=c)
                 elif c == "fixed_displacement":
                     sym = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
-                    for (name, val) in NotebookModel(self.case).getNotebookList():
-                        sym.append((name, 'value (notebook) = ' + str(val)))
+                    sym.extend(self.notebook_symbols)
                     req = ['mesh_displacement[0]',
                            'mesh_displacement[1]',
                            'mesh_displacement[2]']
@@ -1554,8 +1727,7 @@ class meg_to_c_interpreter:
                         elif c == 'flow2_formula':
                             req = ['q_v']
 
-                        for (name, val) in NotebookModel(self.case).getNotebookList():
-                            sym.append((name, 'value (notebook) = ' + str(val)))
+                        sym.extend(self.notebook_symbols)
 
                         name = 'velocity'
 
@@ -1570,8 +1742,7 @@ class meg_to_c_interpreter:
                         exp  = boundary.getDirection('direction_formula')
                         sym = ['x', 'y', 'z', 't', 'dt', 'iter']
 
-                        for (name, val) in NotebookModel(self.case).getNotebookList():
-                            sym.append((name, 'value (notebook) = ' + str(val)))
+                        sym.extend(self.notebook_symbols)
 
                         name = 'direction'
 
@@ -1580,58 +1751,25 @@ class meg_to_c_interpreter:
                                         [], condition=d)
 
                     # Turbulence
+                    # Make sure the formula is "active" (i.e. is
+                    # required by the current turbulence model).
                     tc = boundary.getTurbulenceChoice()
-                    if tc == 'formula':
-                        turb_model = tm.getTurbulenceModel()
+                    if tc == 'formula' and turb_block is not None:
+                        name, req = turb_block
                         sym = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
+                        sym.extend(self.notebook_symbols)
 
-                        # Make sure the formula is "active" (i.e. is
-                        # required by the current turbulence model).
-                        name = None
-
-                        for (k, val) in NotebookModel(self.case).getNotebookList():
-                            sym.append((k, 'value (notebook) = ' + str(val)))
-
-                        if turb_model in ('k-epsilon', 'k-epsilon-PL'):
-                            name = 'turbulence_ke'
-                            req  = ['k', 'epsilon']
-                        elif turb_model in ('Rij-epsilon', 'Rij-SSG'):
-                            name = 'turbulence_rije'
-                            # Careful! The order of rij components must be the
-                            # same as in the code (r23 before r13)
-                            req  = ['r11', 'r22', 'r33',
-                                    'r12', 'r23', 'r13',
-                                    'epsilon']
-                        elif turb_model == 'Rij-EBRSM':
-                            name = 'turbulence_rij_ebrsm'
-                            # Careful! The order of rij components must be the
-                            # same as in the code (r23 before r13)
-                            req  = ['r11', 'r22', 'r33',
-                                    'r12', 'r23', 'r13',
-                                    'epsilon', 'alpha']
-                        elif turb_model == 'v2f-BL-v2/k':
-                            name = 'turbulence_v2f'
-                            req  = ['k', 'epsilon', 'phi', 'alpha']
-                        elif turb_model == 'k-omega-SST':
-                            name = 'turbulence_kw'
-                            req  = ['k', 'omega']
-                        elif turb_model == 'Spalart-Allmaras':
-                            name = 'turbulence_spalart'
-                            req  = ['nu_tilda']
-
-                        if name is not None:
-                            exp = boundary.getTurbFormula()
-                            self.init_block('bnd', zone._label, name,
-                                            exp, req, sym,
-                                            [], condition=tc)
+                        exp = boundary.getTurbFormula()
+                        self.init_block('bnd', zone._label, name,
+                                        exp, list(req), sym,
+                                        [], condition=tc)
 
                 # Specific free_inlet_outlet head loss
                 if zone._nature == 'free_inlet_outlet':
                     name = "head_loss"
                     req  = ['K']
                     sym  = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
-                    for (nb_var, val) in NotebookModel(self.case).getNotebookList():
-                        sym.append((nb_var, 'value (notebook) = ' + str(val)))
+                    sym.extend(self.notebook_symbols)
 
                     exp  = boundary.getHeadLossesFormula()
                     self.init_block('bnd', zone._label, name,
@@ -1642,8 +1780,7 @@ class meg_to_c_interpreter:
                 if zone._nature == 'groundwater':
                     c = boundary.getHydraulicHeadChoice()
                     sym  = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
-                    for (name, val) in NotebookModel(self.case).getNotebookList():
-                        sym.append((name, 'value (notebook) = ' + str(val)))
+                    sym.extend(self.notebook_symbols)
 
                     if c == 'dirichlet_formula':
                         name = 'hydraulic_head'
@@ -1661,8 +1798,7 @@ class meg_to_c_interpreter:
                     c = e[1]
                     exp = e[2]
                     sym  = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
-                    for (name, val) in NotebookModel(self.case).getNotebookList():
-                        sym.append((name, 'value (notebook) = ' + str(val)))
+                    sym.extend(self.notebook_symbols)
 
                     if c == 'dirichlet_formula':
                         if sca in ('vec_potential',):
@@ -1682,7 +1818,6 @@ class meg_to_c_interpreter:
 
         else:
             from code_saturne.model.LocalizationModel import LocalizationModel
-            from code_saturne.model.BoundaryNeptune import Boundary
             from code_saturne.model.MainFieldsModel import MainFieldsModel
             from code_saturne.model.TurbulenceNeptuneModel import TurbulenceModel
             from code_saturne.model.SpeciesModel import SpeciesModel
@@ -1695,10 +1830,9 @@ class meg_to_c_interpreter:
             for zone in blm.getZones():
                 if "inlet" in zone.getNature():
                     for fId in mfm.getFieldIdList():
-                        boundary = Boundary(zone.getNature(),
-                                            zone.getLabel(),
-                                            self.case,
-                                            fId)
+                        boundary = self.get_boundary(zone.getNature(),
+                                                     zone.getLabel(),
+                                                     fId)
 
                         # Velocity
                         c = boundary.getVelocityChoice(fId)
@@ -1711,8 +1845,7 @@ class meg_to_c_interpreter:
                                 req = ['q_m']
                             sym.extend(('t', 'dt', 'iter', 'surface'))
 
-                            for (name, val) in NotebookModel(self.case).getNotebookList():
-                                sym.append((name, 'value (notebook) = ' + str(val)))
+                            sym.extend(self.notebook_symbols)
 
                             exp = boundary.getVelocity(fId)
 
@@ -1731,8 +1864,7 @@ class meg_to_c_interpreter:
                             exp = boundary.getDirection(fId, 'direction_formula')
                             req = ['dir_x', 'dir_y', 'dir_z']
                             sym = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
-                            for (name, val) in NotebookModel(self.case).getNotebookList():
-                                sym.append((name, 'value (notebook) = ' + str(val)))
+                            sym.extend(self.notebook_symbols)
 
                             self.init_block('bnd',
                                             zone.getLabel(),
@@ -1747,18 +1879,16 @@ class meg_to_c_interpreter:
                         tc = boundary.getTurbulenceChoice(fId)
                         turb_model = tm.getTurbulenceModel(fId)
                         if tc == 'formula' and turb_model != 'none':
+                            turb_name = _bnd_turbulence_blocks_neptune.get(turb_model)
+                            if turb_name is None:
+                                msg = 'No boundary formula block defined for ' \
+                                      'turbulence model "%s" (zone %s, field %s)' \
+                                      % (turb_model, zone.getLabel(), fId)
+                                raise Exception(msg)
+
                             exp, reqo, sym = boundary.getTurbFormulaComponents(fId,
                                                                               turb_model)
-                            if turb_model in('k-epsilon', 'k-epsilon_linear_production'):
-                                name = 'turbulence_ke_%s' % (fId)
-                            elif turb_model in ('rij-epsilon_ssg', 'rij-epsilon_ebrsm'):
-                                name = 'turbulence_rije_%s' % (fId)
-                            elif turb_model in ('tchen', 'q2-q12'):
-                                name = 'turbulence_tchen_%s' % (fId)
-                            elif turb_model in ('r2-q12'):
-                                name = 'turbulence_r2q12_%s' % (fId)
-                            elif turb_model in ('r2-r12-tchen'):
-                                name = 'turbulence_r2r12_%s' % (fId)
+                            name = '%s_%s' % (turb_name, fId)
 
                             if type(reqo[0]) == tuple:
                                 req = [r[0] for r in reqo]
@@ -1776,10 +1906,9 @@ class meg_to_c_interpreter:
                 # Thermal conditions
                 if zone.getNature() in ['inlet', 'outlet']:
                     for fId in mfm.getFieldIdList():
-                        boundary = Boundary(zone.getNature(),
-                                            zone.getLabel(),
-                                            self.case,
-                                            fId)
+                        boundary = self.get_boundary(zone.getNature(),
+                                                     zone.getLabel(),
+                                                     fId)
 
                         c = boundary.getEnthalpyChoice(fId)
                         if '_formula' in c:
@@ -1791,8 +1920,7 @@ class meg_to_c_interpreter:
                             elif c in ['temperature_formula', 'timp_K_formula']:
                                 req = ['temperature']
 
-                            for (name, val) in NotebookModel(self.case).getNotebookList():
-                                sym.append((name, 'value (notebook) = ' + str(val)))
+                            sym.extend(self.notebook_symbols)
 
                             exp = boundary.getEnthalpy(fId)
                             self.init_block('bnd',
@@ -1805,10 +1933,9 @@ class meg_to_c_interpreter:
                                             condition=c)
 
                 if zone.getNature() == "wall":
-                    boundary = Boundary(zone.getNature(),
-                                        zone.getLabel(),
-                                        self.case,
-                                        'none')
+                    boundary = self.get_boundary(zone.getNature(),
+                                                 zone.getLabel(),
+                                                 'none')
                     c = boundary.getEnthalpyChoice('none')
                     if '_formula' in c:
                         sym  = ['x', 'y', 'z', 't', 'dt', 'iter', 'surface']
@@ -1819,8 +1946,7 @@ class meg_to_c_interpreter:
                         elif c in ['temperature_formula', 'timp_K_formula']:
                             req = ['temperature']
 
-                        for (name, val) in NotebookModel(self.case).getNotebookList():
-                            sym.append((name, 'value (notebook) = ' + str(val)))
+                        sym.extend(self.notebook_symbols)
 
                         exp = boundary.getEnthalpy('none')
                         self.init_block('bnd',
@@ -1834,10 +1960,9 @@ class meg_to_c_interpreter:
 
                 # Scalars
                 for sp_id in mfm.getFieldIdList(include_none=True):
-                    boundary = Boundary(zone.getNature(),
-                                        zone.getLabel(),
-                                        self.case,
-                                        sp_id)
+                    boundary = self.get_boundary(zone.getNature(),
+                                                 zone.getLabel(),
+                                                 sp_id)
                     if boundary.getNature() != "symmetry":
                         for _s in spm.getScalarByFieldId(sp_id):
                             c = boundary.getScalarChoice(sp_id, _s)
@@ -2143,24 +2268,20 @@ class meg_to_c_interpreter:
         if not self.module_name == 'code_saturne':
             return
 
-        from code_saturne.model.NotebookModel import NotebookModel
-
         from code_saturne.model.LocalizationModel import LocalizationModel
-        from code_saturne.model.Boundary import Boundary
-        from code_saturne.model.TurbulenceModel import TurbulenceModel
 
         blm = LocalizationModel('BoundaryZone', self.case)
 
         for zone in blm.getZones():
 
-            boundary = Boundary(zone._nature, zone._label, self.case)
+            boundary = self.get_boundary(zone._nature, zone._label)
 
             # ALE: imposed mesh velocity
             c = boundary.getALEChoice()
             if c != "internal_coupling":
                 continue
 
-            boundary = Boundary("coupling_mobile_boundary", zone._label, self.case)
+            boundary = self.get_boundary("coupling_mobile_boundary", zone._label)
 
             m_mat = boundary.getMassMatrix()
             k_mat = boundary.getStiffnessMatrix()
@@ -2168,8 +2289,7 @@ class meg_to_c_interpreter:
             f_force = boundary.getFluidForceMatrix()
 
             sym = ['t', 'dt', 'iter']
-            for (name, val) in NotebookModel(self.case).getNotebookList():
-                sym.append((name, 'value (notebook) = ' + str(val)))
+            sym.extend(self.notebook_symbols)
 
             req = ['m11', 'm12', 'm13', 'm21', 'm22', 'm23', 'm31', 'm32', 'm33']
             self.init_block('fsi', zone._label, 'mass_matrix',
@@ -2184,8 +2304,7 @@ class meg_to_c_interpreter:
                             c_mat, req, sym, known_fields=[])
 
             sym = ['t', 'dt', 'iter', 'fluid_fx', 'fluid_fy', 'fluid_fz']
-            for (name, val) in NotebookModel(self.case).getNotebookList():
-                sym.append((name, 'value (notebook) = ' + str(val)))
+            sym.extend(self.notebook_symbols)
             req = ['fx', 'fy', 'fz']
 
             self.init_block('fsi', zone._label, 'fluid_force',
@@ -2196,7 +2315,6 @@ class meg_to_c_interpreter:
     def generate_post_profile_code(self):
         # Output writer activation
 
-        from code_saturne.model.NotebookModel import NotebookModel
         from code_saturne.model.ProfilesModel import ProfilesModel
 
         pfm = ProfilesModel(self.case)
@@ -2211,8 +2329,7 @@ class meg_to_c_interpreter:
             npts = pfm.getNbPoint(l)
 
             sym = ['s']
-            for (name, val) in NotebookModel(self.case).getNotebookList():
-                sym.append((name, 'value (notebook) = ' + str(val)))
+            sym.extend(self.notebook_symbols)
 
             req = ['x', 'y', 'z']
 
@@ -2224,7 +2341,6 @@ class meg_to_c_interpreter:
     def generate_writer_activation_code(self):
         # Output writer activation
 
-        from code_saturne.model.NotebookModel import NotebookModel
         from code_saturne.model.OutputControlModel import OutputControlModel
 
         ocm = OutputControlModel(self.case)
@@ -2240,8 +2356,7 @@ class meg_to_c_interpreter:
                 continue
 
             sym = ['t', 'iter']
-            for (name, val) in NotebookModel(self.case).getNotebookList():
-                sym.append((name, 'value (notebook) = ' + str(val)))
+            sym.extend(self.notebook_symbols)
 
             req = ['is_active']
 
@@ -2284,46 +2399,41 @@ class meg_to_c_interpreter:
         out.close()
         err.close()
 
+        # Compiler output may be long, so accumulate messages in a buffer
         n_errors = 0
-        msg = ''
+        msg = io.StringIO()
         if compilation_test != 0:
-            errors = open('comp.err', 'r').readlines()
-            for i in range(len(errors)):
-                if ': ' in errors[i]:
-                    msg += errors[i].split(': ')[-1].strip()+'\n'
+            with open('comp.err', 'r') as f:
+                errors = f.readlines()
+            for e in errors:
+                if ': ' in e:
+                    msg.write(e.split(': ')[-1].strip()+'\n')
                     n_errors += 1
             if n_errors == 0: # in case we cannot parse the output correctly
                 n_errors += 1
-                for i in range(len(errors)):
-                    msg += errors[i].strip()+'\n'
+                for e in errors:
+                    msg.write(e.strip()+'\n')
 
         os.chdir(cwd)
 
-        return compilation_test, msg, n_errors
+        return compilation_test, msg.getvalue(), n_errors
 
     #---------------------------------------------------------------------------
 
     def clean_tmp_dir(self):
 
         if os.path.exists(self.tmp_path):
-            fl = os.listdir(self.tmp_path)
-            for f in fl:
-                self.delete_file(f, self.tmp_path)
-            os.rmdir(self.tmp_path)
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
 
     #---------------------------------------------------------------------------
 
     def has_meg_code(self):
 
-        retcode = False
-
-        if getRunType(self.case) == 'standard':
-            for func_type in self.funcs.keys():
-                if len(self.funcs[func_type].keys()) > 0:
-                    retcode = True
-                    break
+        # Check for defined formulas first, as it is cheaper than
+        # querying the run type.
 
-        return retcode
+        return any(self.funcs.values()) \
+            and getRunType(self.case) == 'standard'
 
     #---------------------------------------------------------------------------
 
@@ -2363,76 +2473,88 @@ class meg_to_c_interpreter:
 
     #---------------------------------------------------------------------------
 
-    def save_file(self, c_file_name, code_to_write, hard_path=None):
+    def function_code_fragments(self, func_type):
 
-        if code_to_write != '':
-            # Try and write the function in the src if in RESU folder
-            # For debugging purposes
-            try:
-                fpath = self.__file_path__(c_file_name, hard_path=hard_path)
-                new_file = open(fpath, 'w')
-                new_file.write(self.clean_lines(code_to_write))
-                new_file.close()
-                return 1
-
-            except:
-                # Cant save the function. xml file will still be saved
-                return 2
+        # Generate the code for all blocks of a given function type,
+        # fragment by fragment.
 
-        # Return 0 if nothing is written for robustness
-        else:
-            return 0
+        # Header and footer templates contain no trailing whitespace,
+        # so only generated blocks need to be cleaned.
 
-    #---------------------------------------------------------------------------
+        yield _function_prologue[self.module_name][func_type]
 
-    def save_function(self, func_type, hard_path = None):
+        # Bind methods used for each block to locals
+        write_block = self.write_block
+        clean_lines = self.clean_lines
 
-        # Delete previous existing file
-        file2write = _function_names[func_type]
-        self.delete_file(file2write)
+        first = True
+        for key, func_params in self.funcs[func_type].items():
+            w_block = write_block(func_type, key)
+            if w_block is not None:
+                if not first:
+                    yield '\n'
+                first = False
+                yield func_params.banner + clean_lines(w_block)
 
-        # Check if it is a standard computation
-        if getRunType(self.case) != 'standard':
-            return 0
+        yield _function_epilogue[func_type]
 
-        # Generate the functions code if needed
-        code_to_write = ''
-        if len(self.funcs[func_type].keys()) > 0:
-            code_to_write = _file_header
-#            if self.module_name != "code_saturne":
-#                code_to_write += _file_header2
-            code_to_write += _file_header3
-            code_to_write += _function_header[func_type]
-            k_count = 0
-            for key in self.funcs[func_type].keys():
-                w_block = self.write_block(func_type, key)
-                if w_block is None:
-                    continue
-                zone_name, var_name = key.split('::')
-                var_name = var_name.replace("+", ", ")
-                m1 = _block_comments[func_type] % (var_name, zone_name)
-                m2 = '  -' + '-'*len(m1) + ' */\n\n'
-                m1 = '/* ' + m1 + '\n'
+    #---------------------------------------------------------------------------
 
-                if k_count > 0:
-                    code_to_write += '\n'
-                code_to_write += '  ' + m1
-                code_to_write += '  ' + m2
-                code_to_write += w_block
+    def save_function(self, func_type, hard_path = None, run_type = None):
 
-                k_count += 1
+        file2write = _function_names[func_type]
+        fpath = self.__file_path__(file2write, hard_path=hard_path)
+
+        # Return 0 if nothing is written for robustness, or if it is
+        # not a standard computation (checking for formulas first,
+        # as it is cheaper than querying the run type if not given)
+        if not self.funcs[func_type] \
+           or (run_type or getRunType(self.case)) != 'standard':
+            self.delete_file(file2write)
+            return 0
 
-            if func_type in ['bnd', 'src', 'ini']:
-                code_to_write += '  return new_vals;\n'
+        # Delete previous existing file, unless it is the one regenerated
+        # here, which is kept as is if unchanged.
+        if fpath != self.__file_path__(file2write):
+            self.delete_file(file2write)
+
+        # Generate the functions code, streaming it to a temporary file
+        # which then replaces the previous one, so that the C file is
+        # never left partially written.
+        # Try and write the function in the src if in RESU folder
+        # For debugging purposes
+
+        tmp_fpath = fpath + '.tmp'
+
+        try:
+            with open(tmp_fpath, 'w', buffering=1<<20) as new_file:
+                new_file.writelines(self.function_code_fragments(func_type))
+
+            # Do not replace an identical file, so that its timestamp is
+            # kept and it is not needlessly recompiled (the filecmp cache,
+            # keyed on size and mtime, could hide a change made within
+            # the timestamp resolution, so it is cleared first).
+            filecmp.clear_cache()
+            if os.path.isfile(fpath) \
+               and filecmp.cmp(tmp_fpath, fpath, shallow=False):
+                os.remove(tmp_fpath)
+            else:
+                os.replace(tmp_fpath, fpath)
 
-            code_to_write += _file_footer
+        except OSError:
+            # Cant save the function. xml file will still be saved
+            if os.path.isfile(tmp_fpath):
+                os.remove(tmp_fpath)
+            return 2
 
-        # Write the C file if necessary
-        save_status = self.save_file(file2write,
-                                     code_to_write,
-                                     hard_path = hard_path)
+        except Exception:
+            # Do not leave a previous or partially generated file
+            if os.path.isfile(tmp_fpath):
+                os.remove(tmp_fpath)
+            self.delete_file(file2write, hard_path=hard_path)
+            raise
 
-        return save_status
+        return 1
 
     #---------------------------------------------------------------------------
 
@@ -2442,20 +2564,26 @@ class meg_to_c_interpreter:
 
         is_empty    = 0
         empty_exps  = []
+
+        # The run type is the same for all functions, so query it only once
+        run_type = None
+        if any(self.funcs.values()):
+            run_type = getRunType(self.case)
+
         for func_type in self.funcs.keys():
             try:
-                state = self.save_function(func_type)
+                state = self.save_function(func_type, run_type=run_type)
             except Exception as e:
                 msg = "Error while generating \"%s\" formulae.\n" % \
                         _func_short_to_long[func_type]
                 msg+=str(e)
                 _error_and_exit(msg)
 
-            if state != 0:
-                save_status = state
+            # Keep the most severe status (2 if any file could not be saved)
+            save_status = max(save_status, state)
 
             for ek in self.funcs[func_type].keys():
-                if self.funcs[func_type][ek]['exp'] in [None, ""]:
+                if self.funcs[func_type][ek].exp in [None, ""]:
                     is_empty = 1
 
                     empty_exps.append({})
@@ -2472,6 +2600,37 @@ class meg_to_c_interpreter:
 
         return ret
 
+#-------------------------------------------------------------------------------
+# MEG to C translator test case
+#-------------------------------------------------------------------------------
+
+class MegToCTestCase(unittest.TestCase):
+
+    def checkExpressionNamesWithComment(self):
+        """Check that names directly followed by a comment are found"""
+        names = expression_names('y = beta# comment\n + gamma// other\n;')
+        assert 'beta' in names and 'gamma' in names, \
+            'Could not find names followed by a comment in an expression'
+        assert 'comment' not in names and 'other' not in names, \
+            'Comment contents found as names in an expression'
+
+    def checkExpressionNamesFluidProperty(self):
+        """Check that a reference fluid property before a comment is found"""
+        names = expression_names('molecular_viscosity = mu0# comment\n + beta*t;')
+        assert {'mu0', 'beta', 't'} <= names, \
+            'Could not find fluid property followed by a comment'
+
+
+def suite():
+    testSuite = unittest.makeSuite(MegToCTestCase, "check")
+    return testSuite
+
+
+def runTest():
+    print(__file__)
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
+
 #-------------------------------------------------------------------------------
 # End
 #-------------------------------------------------------------------------------